@@ -4,57 +4,79 @@ TikTok Downloader Bot - Koyeb Optimized
 """
 
 import os
+import re
 import sys
-import requests
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
-import threading
+import asyncio
+import hashlib
 import time
-import requests
+from collections import defaultdict, deque
+from urllib.parse import quote, urlsplit, urlunsplit
+import httpx
+import orjson
+from aiohttp import web
+from cachetools import TTLCache
 
-# Setup logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Faster event loop where available (not on Windows)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+# Setup logging - records go through a queue, written by a listener thread
+log_queue = queue.Queue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+# QueueHandler goes on the root logger directly: via basicConfig it would get a
+# default formatter and every line would be formatted twice
+root_logger = logging.getLogger()
+root_logger.addHandler(QueueHandler(log_queue))
+root_logger.setLevel(os.environ.get("LOG_LEVEL", "WARNING").upper())
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-print("=" * 60)
-print("🤖 TikTok Bot - Koyeb Deployment")
-print("=" * 60)
+logger.info("🤖 TikTok Bot - Koyeb Deployment")
 
 # Import Telegram modules
 try:
     from telegram import Update, InputMediaPhoto
-    from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-    print("✅ Packages imported")
+    from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
+    logger.info("✅ Packages imported")
 except ImportError as e:
-    print(f"❌ Missing: {e}")
+    logger.error("❌ Missing: %s", e)
     sys.exit(1)
 
 # ============ CONFIGURATION ============
 BOT_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 if not BOT_TOKEN:
-    print("❌ ERROR: TELEGRAM_TOKEN not set!")
-    print("\nSet in Koyeb Dashboard:")
-    print("1. Go to your Service")
-    print("2. Click 'Variables' tab")
-    print("3. Add: TELEGRAM_TOKEN = your_token")
+    logger.error(
+        "❌ ERROR: TELEGRAM_TOKEN not set!\n"
+        "Set in Koyeb Dashboard:\n"
+        "1. Go to your Service\n"
+        "2. Click 'Variables' tab\n"
+        "3. Add: TELEGRAM_TOKEN = your_token"
+    )
     sys.exit(1)
 
 PORT = int(os.environ.get("PORT", 8080))
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # Telegram bot upload limit
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 8))
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
 
 # ============ HEALTH CHECK SERVER ============
-print("🚀 Starting health check server...")
+# Served by aiohttp on the bot's own event loop (started in post_init)
 
-from flask import Flask, jsonify
-from threading import Thread
-
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return """
+async def home(request):
+    return web.Response(text="""
     <html>
         <body style="font-family: Arial, sans-serif; text-align: center; padding: 50px;">
             <h1>🤖 TikTok Downloader Bot</h1>
@@ -64,132 +86,498 @@ def home():
             <p>Time: """ + datetime.now().strftime("%H:%M:%S") + """</p>
         </body>
     </html>
-    """
-
-@app.route('/health')
-def health():
-    return jsonify({
-        "status": "healthy",
-        "service": "tiktok-bot",
-        "timestamp": datetime.now().isoformat(),
-        "telegram": "connected",
-        "keep_alive": "active",
-        "memory": "ok",
-        "requests_served": "active"
-    })
+    """, content_type="text/html")
+
+def json_response(data):
+    """JSON response encoded with orjson"""
+    return web.Response(body=orjson.dumps(data), content_type="application/json")
 
-@app.route('/ping')
-def ping_endpoint():
+# Static body - probes only check the status code
+HEALTH_BODY = b'{"status":"healthy","service":"tiktok-bot"}'
+
+async def health(request):
+    return web.Response(body=HEALTH_BODY, content_type="application/json")
+
+async def ping_endpoint(request):
     """Simple ping endpoint"""
-    return "PONG", 200
+    return web.Response(text="PONG")
 
-@app.route('/status')
-def status():
-    return jsonify({
+async def status(request):
+    return json_response({
         "bot": "running",
         "platform": "koyeb",
         "tier": "free",
         "uptime": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     })
 
-def run_flask():
-    """Run Flask in separate thread"""
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+async def metrics(request):
+    """Circuit breaker counters per provider"""
+    return json_response({
+        name: {"state": breaker.state(), "fails": breaker.fails}
+        for name, breaker in BREAKERS.items()
+    })
 
-# Start health check
-Thread(target=run_flask, daemon=True).start()
-print(f"✅ Health check running on port {PORT}")
+async def start_health_server():
+    """Start health check server, returns its runner"""
+    logger.info("🚀 Starting health check server...")
+    health_app = web.Application()
+    health_app.add_routes([
+        web.get('/', home),
+        web.get('/health', health),
+        web.get('/ping', ping_endpoint),
+        web.get('/status', status),
+        web.get('/metrics', metrics),
+    ])
+    runner = web.AppRunner(health_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    logger.info("✅ Health check running on port %s", PORT)
+    return runner
 
-# ============ TIKTOK FUNCTIONS ============
+# ============ HTTP CLIENT ============
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 "
+        "(KHTML, like Gecko) Mobile/15E148 TikTok 32.5.4"
+    ),
+    "Accept": "application/json"
+}
+
+# Download API endpoints, {} is the percent-encoded TikTok URL
+API_URLS = {
+    "tikwm": "https://www.tikwm.com/api/?url={}&hd=1",
+    "tiklydown": "https://api.tiklydown.eu.org/api/download?url={}"
+}
+
+# Shared async client: keep-alive + connection pool, reused by every handler
+HTTP = httpx.AsyncClient(
+    timeout=30,
+    headers=HEADERS,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    http2=False
+)
+
+# Media client for TikTok CDN downloads: HTTP/2 multiplexes album/video fetches
+MEDIA_HTTP = httpx.AsyncClient(
+    timeout=20,
+    headers={
+        "User-Agent": HEADERS["User-Agent"],
+        "Referer": "https://www.tiktok.com/"
+    },
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    http2=True
+)
+
+# ============ CACHE ============
+# API results keyed by TikTok ID (or sha1 of the normalized URL)
+CACHE = TTLCache(maxsize=2048, ttl=3600)
+CACHE_LOCK = asyncio.Lock()
+# Short link (vm./vt.tiktok.com) -> canonical URL
+SHORT_LINKS = TTLCache(maxsize=10000, ttl=86400)
+SHORT_HOSTS = ("vm.tiktok.com", "vt.tiktok.com", "v.douyin.com")
+# Cache key / short link -> future of the request currently fetching it
+INFLIGHT: dict[str, asyncio.Future] = {}
+SHORT_INFLIGHT: dict[str, asyncio.Future] = {}
 
-def download_tiktok(url: str):
-    """Download TikTok video or slideshow with HD quality"""
+async def coalesce(inflight: dict, key: str, fetch):
+    """Run fetch() once per key; concurrent callers share its result"""
+    if key in inflight:
+        logger.debug("⏳ Joining in-flight request")
+        return await asyncio.shield(inflight[key])
+    
+    fut = asyncio.get_running_loop().create_future()
+    inflight[key] = fut
     try:
-        # Try HD quality first
-        api_url = f"https://www.tikwm.com/api/?url={url}&hd=1"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Accept": "application/json"
-        }
-        
-        print(f"🔍 Requesting HD quality from: {api_url[:80]}...")
-        
-        response = requests.get(api_url, headers=headers, timeout=30)
+        result = await fetch()
+        fut.set_result(result)
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # waiters get it; don't log as unretrieved
+        raise
+    finally:
+        del inflight[key]
+        if not fut.done():
+            fut.cancel()
+    return result
+
+async def resolve_short_link(url: str):
+    """Follow a short link's redirects, returns the canonical post URL or None"""
+    try:
+        response = await HTTP.head(url, timeout=10, follow_redirects=True)
+    except httpx.HTTPError as e:
+        logger.warning("⚠️ Short link resolve failed: %s", e)
+        return None
+    canonical = str(response.url)
+    # Geo-block / bot-check redirects land on the homepage: not a post, don't trust it
+    if not extract_video_id(canonical):
+        logger.warning("⚠️ Short link redirected to a non-post URL: %.80s", canonical)
+        return None
+    SHORT_LINKS[url] = canonical
+    return canonical
+
+async def normalize_url(url: str):
+    """Strip query string, lowercase host and resolve short links.
+    A short link that doesn't resolve to a post is returned unchanged"""
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    
+    if host in SHORT_HOSTS:
+        canonical = SHORT_LINKS.get(url)
+        if canonical is None:
+            canonical = await coalesce(SHORT_INFLIGHT, url, lambda: resolve_short_link(url))
+        if canonical is None:
+            return url
+        parts = urlsplit(canonical)
+        host = parts.netloc.lower()
+    
+    return urlunsplit((parts.scheme.lower() or "https", host, parts.path.rstrip("/"), "", ""))
+
+ID_PATTERNS = tuple(re.compile(p) for p in (r'/video/(\d+)', r'/photo/(\d+)', r'/v/(\d+)'))
+
+def extract_video_id(url: str):
+    """Numeric video/photo ID from a TikTok URL, or None"""
+    for pattern in ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1)
+    return None
+
+def cache_key(normalized_url: str):
+    """Cache key: the TikTok ID when present, else sha1 of the URL"""
+    video_id = extract_video_id(normalized_url)
+    if video_id:
+        return video_id
+    return hashlib.sha1(normalized_url.encode()).hexdigest()
+
+# ============ CIRCUIT BREAKER ============
+BREAKER_THRESHOLD = 5  # consecutive failed requests before a provider is skipped
+BREAKER_COOLDOWN = 60  # seconds before a single probe call is allowed
+
+class Breaker:
+    """Per-provider circuit breaker (closed / open / half_open)"""
+    __slots__ = ("fails", "opened_at")
+    
+    def __init__(self):
+        self.fails = 0
+        self.opened_at = 0.0
+    
+    def state(self):
+        if self.fails < BREAKER_THRESHOLD:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+            return "open"
+        return "half_open"
+    
+    def allow(self):
+        """Whether a call may go through; claims the probe when half open"""
+        state = self.state()
+        if state == "half_open":
+            # Re-arm the cooldown so concurrent callers wait for this probe
+            self.opened_at = time.monotonic()
+        return state != "open"
+    
+    def success(self):
+        self.fails = 0
+    
+    def failure(self):
+        self.fails += 1
+        self.opened_at = time.monotonic()
+
+BREAKERS = defaultdict(Breaker)
+
+# ============ API TIMEOUTS ============
+# Starting read timeouts per API (seconds), retuned from observed latency
+BASE_TIMEOUTS = {"tikwm": 3, "tiklydown": 5}
+CONNECT_TIMEOUT = 1
+MAX_READ_TIMEOUT = 15
+LATENCY_SAMPLES = 100
+RETUNE_EVERY = 20  # samples between timeout recomputations
+
+TIMEOUTS = {name: httpx.Timeout(read, connect=CONNECT_TIMEOUT) for name, read in BASE_TIMEOUTS.items()}
+LATENCIES = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+# Samples recorded per API since start; the window above is capped, this isn't
+SAMPLE_COUNTS = defaultdict(int)
+
+def p95(samples):
+    """95th percentile of a sample window"""
+    ordered = sorted(samples)
+    return ordered[int(len(ordered) * 0.95) - 1] if len(ordered) >= 20 else ordered[-1]
+
+def record_latency(name: str, seconds: float):
+    """Store a response time and retune the API's read timeout to ~1.5x p95"""
+    samples = LATENCIES[name]
+    samples.append(seconds)
+    SAMPLE_COUNTS[name] += 1
+    if SAMPLE_COUNTS[name] % RETUNE_EVERY == 0:
+        read = min(max(p95(samples) * 1.5, CONNECT_TIMEOUT), MAX_READ_TIMEOUT)
+        TIMEOUTS[name] = httpx.Timeout(read, connect=CONNECT_TIMEOUT)
+        logger.info("⏱️ %s read timeout now %.1fs", name, read)
+
+async def api_get(name: str, api_url: str):
+    """GET an API with its tuned timeout, recording the response time"""
+    timeout = TIMEOUTS[name]
+    started = time.monotonic()
+    try:
+        response = await HTTP.get(api_url, timeout=timeout)
+    except httpx.ReadTimeout:
+        # Count as a sample at the limit so a slower API earns a longer read timeout;
+        # connect/pool timeouts say nothing about read latency and aren't recorded
+        record_latency(name, timeout.read)
+        raise
+    record_latency(name, time.monotonic() - started)
+    return response
+
+# ============ TIKTOK FUNCTIONS ============
+
+async def download_tiktok(url: str):
+    """Download TikTok content, serving repeat URLs from cache"""
+    # Providers get the canonical URL, so short links are resolved only once
+    url = await normalize_url(url)
+    key = cache_key(url)
+    
+    if CACHE_ENABLED:
+        async with CACHE_LOCK:
+            if key in CACHE:
+                logger.debug("⚡ Cache hit")
+                return CACHE[key]
+    
+    # Same post already being fetched: share that request
+    return await coalesce(INFLIGHT, key, lambda: fetch_and_store(key, url))
+
+async def fetch_and_store(key: str, url: str):
+    """Fetch from the providers and cache a successful result"""
+    result = await fetch_tiktok(url)
+    if CACHE_ENABLED and result["success"]:
+        async with CACHE_LOCK:
+            CACHE[key] = result
+    return result
+
+class UpstreamError(Exception):
+    """API is erroring, rate limiting or blocking us - worth retrying, unlike a bad link"""
+
+# Rate limited (429) or blocked, e.g. by Cloudflare (403)
+BLOCKED_STATUSES = (403, 429)
+
+def check_upstream(name: str, response):
+    """Raise UpstreamError for 5xx, 429 and 403 responses"""
+    if response.status_code >= 500 or response.status_code in BLOCKED_STATUSES:
+        raise UpstreamError(f"{name} returned {response.status_code}")
+
+def as_list(value):
+    """A single URL as a one-item list; lists pass through, anything else is None"""
+    if isinstance(value, str):
+        return [value]
+    return value if isinstance(value, list) else None
+
+async def try_tikwm(url: str):
+    """TikWM API: HD video or slideshow"""
+    api_url = API_URLS["tikwm"].format(quote(url, safe=''))
+    
+    logger.debug("🔍 Requesting HD quality from: %.80s...", api_url)
+    
+    response = await api_get("tikwm", api_url)
+    check_upstream("tikwm", response)
+    
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        logger.debug("📊 API Response: %s", data.get('code', 'no code'))
         
-        if response.status_code == 200:
-            data = response.json()
-            print(f"📊 API Response: {data.get('code', 'no code')}")
+        if data.get("code") == 0 and data.get("data"):
+            content = data["data"]
+            author_obj = content.get("author")
+            author = author_obj.get("nickname", "") if isinstance(author_obj, dict) else ""
+            
+            # Slideshow detection
+            images = as_list(content.get("images"))
+            if images:
+                return {
+                    "success": True,
+                    "type": "slideshow",
+                    "images": images[:10],  # Telegram limit
+                    "count": len(images),
+                    "title": content.get("title", "TikTok Slideshow")[:100],
+                    "author": author
+                }
+            
+            # Video detection - HD without watermark, else normal
+            video_url = content.get("hdplay") or content.get("play")
             
-            if data.get("code") == 0 and data.get("data"):
-                content = data["data"]
-                
-                # Slideshow detection
-                images = content.get("images")
-                if images:
-                    if isinstance(images, str):
-                        images = [images]
-                    
-                    return {
-                        "success": True,
-                        "type": "slideshow",
-                        "images": images[:10],  # Telegram limit
-                        "title": content.get("title", "TikTok Slideshow")[:100],
-                        "author": content.get("author", {}).get("nickname", "")
-                    }
-                
-                # Video detection - Try HD first, then normal
-                video_url = content.get("hdplay")  # HD without watermark
-                quality = "HD"
-                
-                if not video_url:
-                    video_url = content.get("play")  # Normal without watermark
-                    quality = "Normal"
-                    print("⚠️ HD not available, using normal quality")
-                
-                if video_url:
-                    quality_label, size_mb = check_video_quality(video_url)
-                    print(f"✅ Quality: {quality_label}, Size: {size_mb:.1f}MB")
-                    
-                    return {
-                        "success": True,
-                        "type": "video",
-                        "video_url": video_url,
-                        "title": content.get("title", "TikTok Video")[:100],
-                        "quality": quality_label,
-                        "size_mb": f"{size_mb:.1f}",
-                        "author": content.get("author", {}).get("nickname", "")
-                    }
-                else:
-                    print("❌ No video URL found in API response")
-        
-        # If HD API fails, try alternative API
-        print("🔄 Trying alternative API...")
-        alt_api = f"https://api.tiklydown.eu.org/api/download?url={url}"
-        response = requests.get(alt_api, headers=headers, timeout=15)
-        
-        if response.status_code == 200:
-            data = response.json()
-            video_url = data.get("videoUrl")
             if video_url:
+                # Quality is probed by fetch_tiktok once this result has won
                 return {
                     "success": True,
                     "type": "video",
                     "video_url": video_url,
-                    "title": data.get("desc", "TikTok Video")[:100],
-                    "quality": "Normal",
-                    "api": "alternative"
+                    "title": content.get("title", "TikTok Video")[:100],
+                    "author": author
                 }
+            else:
+                logger.warning("❌ No video URL found in API response")
     
-    except Exception as e:
-        logger.error(f"Download error: {e}")
-        print(f"❌ Exception: {e}")
+    return None
+
+async def try_tiklydown(url: str):
+    """Tiklydown API: normal quality video"""
+    logger.debug("🔄 Trying alternative API...")
+    alt_api = API_URLS["tiklydown"].format(quote(url, safe=''))
+    response = await api_get("tiklydown", alt_api)
+    check_upstream("tiklydown", response)
+    
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        video_url = data.get("videoUrl")
+        if video_url:
+            return {
+                "success": True,
+                "type": "video",
+                "video_url": video_url,
+                "title": data.get("desc", "TikTok Video")[:100],
+                "quality": "Normal",
+                "api": "alternative"
+            }
+    
+    return None
+
+# Providers in quality order (HD first); a lower one leads only while the ones above it are failing
+# Keyed by the name shared with API_URLS, TIMEOUTS, BREAKERS, /stats and /metrics
+PROVIDERS = {"tikwm": try_tikwm, "tiklydown": try_tiklydown}
+PROVIDER_ATTEMPTS = 3
+HEDGE_DELAY = 0.4  # head start before the next provider is fired
+FALLBACK_WINDOW = 60  # seconds a promoted fallback provider leads
+fallback_provider = None
+fallback_until = 0.0
+# Failures worth retrying: network errors, timeouts, 5xx/429/403 and garbled bodies
+TRANSIENT_ERRORS = (httpx.HTTPError, UpstreamError, orjson.JSONDecodeError)
+
+async def run_provider(name: str, url: str, failed: set):
+    """Call one provider, retrying transient upstream errors with backoff.
+    Adds its name to `failed` when the upstream itself is broken in this request"""
+    provider = PROVIDERS[name]
+    breaker = BREAKERS[name]
+    if not breaker.allow():
+        logger.warning("⛔ %s circuit open, skipping", name)
+        failed.add(name)
+        return None
+    
+    errored = False
+    try:
+        for attempt in range(PROVIDER_ATTEMPTS):
+            try:
+                result = await provider(url)
+            except TRANSIENT_ERRORS as e:
+                logger.warning("%s attempt %d failed: %s", name, attempt + 1, e)
+                errored = True
+                if attempt < PROVIDER_ATTEMPTS - 1:
+                    await asyncio.sleep(0.3 * 2 ** attempt)
+                continue
+            except Exception as e:
+                logger.error("Download error (%s): %s", name, e)
+                return None
+            
+            # The API answered, so it is healthy even if the post isn't downloadable.
+            # None is a definitive answer (private/deleted post) - don't retry it
+            breaker.success()
+            return result
+    except asyncio.CancelledError:
+        # Lost the hedge while retrying an upstream error: still a failed request
+        if errored:
+            breaker.failure()
+            failed.add(name)
+        raise
     
-    return {"success": False, "error": "Failed to download video"}
+    # Every attempt hit an upstream error: one failure for the breaker
+    breaker.failure()
+    failed.add(name)
+    return None
+
+def provider_order():
+    """PROVIDERS in quality order, minus open circuits, promoted fallback first"""
+    providers = [name for name in PROVIDERS if BREAKERS[name].state() != "open"]
+    if fallback_provider in providers and time.monotonic() < fallback_until:
+        providers.remove(fallback_provider)
+        providers.insert(0, fallback_provider)
+    return providers
+
+async def fetch_tiktok(url: str):
+    """Download TikTok video or slideshow, first successful provider wins"""
+    global fallback_provider, fallback_until
+    
+    remaining = provider_order()
+    # Providers broken in this request (skipped open circuits count as broken)
+    failed = {name for name in PROVIDERS if name not in remaining}
+    running = {}
+    result = winner = None
+    
+    try:
+        while (remaining or running) and not result:
+            if remaining:
+                provider = remaining.pop(0)
+                running[asyncio.create_task(run_provider(provider, url, failed))] = provider
+            
+            # Hedge: fire the next provider if nothing succeeded within HEDGE_DELAY
+            done, _ = await asyncio.wait(
+                running,
+                timeout=HEDGE_DELAY if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                provider = running.pop(task)
+                outcome = task.result()
+                if outcome and not result:
+                    result, winner = outcome, provider
+    finally:
+        for task in running:
+            task.cancel()
+        # Let cancelled providers finish their breaker/failed bookkeeping
+        await asyncio.gather(*running, return_exceptions=True)
+    
+    if not result:
+        return {"success": False, "error": "Failed to download video"}
+    
+    # Promote a lower-ranked winner only if every provider above it broke in
+    # this request; winning a race against a slow but healthy provider doesn't count
+    ranked = list(PROVIDERS)
+    rank = ranked.index(winner)
+    if rank == 0:
+        fallback_provider = None
+    elif all(name in failed for name in ranked[:rank]):
+        fallback_provider = winner
+        fallback_until = time.monotonic() + FALLBACK_WINDOW
+    
+    # Probe quality outside the hedge so it doesn't slow the HD provider's race
+    if result["type"] == "video" and "quality" not in result:
+        quality_label, size_mb = await check_video_quality(result["video_url"])
+        logger.debug("✅ Quality: %s, Size: %.1fMB", quality_label, size_mb)
+        result = {**result, "quality": quality_label, "size_mb": f"{size_mb:.1f}"}
+    
+    return result
+
+async def fetch_video(video_url: str):
+    """Download video bytes over the shared client"""
+    buffer = bytearray()
+    async with MEDIA_HTTP.stream("GET", video_url, timeout=60, follow_redirects=True) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(64 * 1024):
+            buffer += chunk
+            if len(buffer) > MAX_UPLOAD_BYTES:
+                raise ValueError("video exceeds Telegram upload limit")
+    return bytes(buffer)
+
+async def fetch_image(image_url: str):
+    """Download one image over the media client"""
+    response = await MEDIA_HTTP.get(image_url, follow_redirects=True)
+    response.raise_for_status()
+    return response.content
+
+async def fetch_images(image_urls: list):
+    """Download images concurrently; any that fail fall back to their URL"""
+    blobs = await asyncio.gather(*(fetch_image(u) for u in image_urls), return_exceptions=True)
+    return [u if isinstance(b, Exception) else b for u, b in zip(image_urls, blobs)]
 
 # ============ KEEP ALIVE SYSTEM ============
-def keep_alive_ping():
+async def keep_alive_ping():
     """Ping own health endpoint to prevent sleeping"""
-    print("🔧 Starting keep-alive ping system...")
+    logger.info("🔧 Starting keep-alive ping system...")
     
     while True:
         try:
@@ -197,152 +585,196 @@ def keep_alive_ping():
             current_time = datetime.now().strftime("%H:%M:%S")
             
             # Try to ping health endpoint
-            response = requests.get(f"http://localhost:{PORT}/health", timeout=10)
+            response = await HTTP.get(f"http://localhost:{PORT}/health", timeout=10)
             
             if response.status_code == 200:
-                print(f"✅ [{current_time}] Keep-alive ping successful")
+                logger.debug("✅ [%s] Keep-alive ping successful", current_time)
             else:
-                print(f"⚠️ [{current_time}] Ping failed: {response.status_code}")
+                logger.warning("⚠️ [%s] Ping failed: %s", current_time, response.status_code)
                 
         except Exception as e:
-            print(f"❌ [{current_time}] Keep-alive error: {str(e)[:50]}")
+            logger.warning("❌ [%s] Keep-alive error: %.50s", current_time, e)
         
         # Ping every 4 minutes (240 seconds)
-        time.sleep(240)
+        await asyncio.sleep(240)
 
 def start_keep_alive():
-    """Start keep-alive in background thread"""
-    keep_alive_thread = threading.Thread(target=keep_alive_ping, daemon=True)
-    keep_alive_thread.start()
-    print("✅ Keep-alive system started (pings every 4 minutes)")
+    """Start keep-alive as a task on the bot's event loop"""
+    task = asyncio.create_task(keep_alive_ping())
+    logger.info("✅ Keep-alive system started (pings every 4 minutes)")
+    return task
 
 # ============ BOT COMMANDS ============
 
+# Limits how many URLs are processed at once
+SEM = asyncio.Semaphore(MAX_CONCURRENCY)
+# TikTok/Douyin link anywhere in the message (host must end in the domain)
+TT_RE = re.compile(r"https?://(?:[\w-]+\.)*(?:tiktok|douyin)\.com/[^\s]+", re.I)
+
+# Reply texts, built once
+START_TMPL = (
+    "👋 Hello {name}!\n\n"
+    "🎬 *TikTok Downloader Bot*\n\n"
+    "📥 Just send me any TikTok URL and I'll download it!\n\n"
+    "✅ *Features:*\n"
+    "• Videos with sound\n"
+    "• Slideshow images\n"
+    "• HD quality\n"
+    "• 24/7 on Koyeb\n\n"
+    "🔗 *Examples:*\n"
+    "• https://vm.tiktok.com/abc123/\n"
+    "• https://tiktok.com/@user/video/123\n\n"
+    "Try it now! 🚀"
+)
+
+HELP_TEXT = (
+    "🆘 *Help*\n\n"
+    "Just send a TikTok URL!\n\n"
+    "*Commands:*\n"
+    "/start - Welcome\n"
+    "/help - This message\n"
+    "/ping - Check bot\n"
+    "/stats - API response times\n\n"
+    "*Need help?*\n"
+    "1. Use public TikTok URLs\n"
+    "2. Try different URL if fails\n"
+    "3. Some videos are private\n\n"
+    "Hosted on Koyeb • Always Free"
+)
+
+PING_TMPL = (
+    "🏓 Pong!\n\n"
+    "🤖 Bot is online\n"
+    "🕐 {time}\n"
+    "⚡ Powered by Koyeb"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command"""
     user = update.effective_user
-    await update.message.reply_text(
-        f"👋 Hello {user.first_name}!\n\n"
-        "🎬 *TikTok Downloader Bot*\n\n"
-        "📥 Just send me any TikTok URL and I'll download it!\n\n"
-        "✅ *Features:*\n"
-        "• Videos with sound\n"
-        "• Slideshow images\n"
-        "• HD quality\n"
-        "• 24/7 on Koyeb\n\n"
-        "🔗 *Examples:*\n"
-        "• https://vm.tiktok.com/abc123/\n"
-        "• https://tiktok.com/@user/video/123\n\n"
-        "Try it now! 🚀",
-        parse_mode='Markdown'
-    )
+    await update.message.reply_text(START_TMPL.format(name=user.first_name), parse_mode='Markdown')
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Help command"""
-    await update.message.reply_text(
-        "🆘 *Help*\n\n"
-        "Just send a TikTok URL!\n\n"
-        "*Commands:*\n"
-        "/start - Welcome\n"
-        "/help - This message\n"
-        "/ping - Check bot\n\n"
-        "*Need help?*\n"
-        "1. Use public TikTok URLs\n"
-        "2. Try different URL if fails\n"
-        "3. Some videos are private\n\n"
-        "Hosted on Koyeb • Always Free",
-        parse_mode='Markdown'
-    )
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ping command"""
     await update.message.reply_text(
-        f"🏓 Pong!\n\n"
-        f"🤖 Bot is online\n"
-        f"🕐 {datetime.now().strftime('%H:%M:%S')}\n"
-        f"⚡ Powered by Koyeb",
+        PING_TMPL.format(time=datetime.now().strftime('%H:%M:%S')),
         parse_mode='Markdown'
     )
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stats command - API latency and current timeouts"""
+    lines = ["📈 API stats\n"]
+    for name in BASE_TIMEOUTS:
+        samples = LATENCIES[name]
+        p95_text = f"{p95(samples):.2f}s" if samples else "n/a"
+        lines.append(
+            f"• {name}: {len(samples)} calls, p95 {p95_text}, "
+            f"timeout {TIMEOUTS[name].read:.1f}s"
+        )
+    await update.message.reply_text("\n".join(lines))
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle TikTok URLs"""
-    url = update.message.text.strip()
-    
-    if "tiktok.com" not in url:
+    m = TT_RE.search(update.message.text or "")
+    if not m:
         await update.message.reply_text("❌ Please send a valid TikTok URL")
         return
+    url = m.group(0)
     
     msg = await update.message.reply_text("⏳ Processing... This may take 20-30 seconds.")
     
-    try:
-        result = download_tiktok(url)
+    async with SEM:
+        try:
+            result = await download_tiktok(url)
         
-        if not result["success"]:
-            await msg.edit_text(f"❌ Failed: {result.get('error', 'Unknown error')}")
-            return
+            if not result["success"]:
+                await msg.edit_text(f"❌ Failed: {result.get('error', 'Unknown error')}")
+                return
         
-        # Slideshow
-        if result["type"] == "slideshow":
-            images = result["images"]
-            title = result["title"]
+            # Slideshow
+            if result["type"] == "slideshow":
+                images = result["images"]
+                count = result["count"]
+                title = result["title"]
+            
+                await msg.edit_text(f"📸 Found {count} images. Sending...")
             
-            await msg.edit_text(f"📸 Found {len(images)} images. Sending...")
+                caption = f"🖼️ {title}\n"
+                if result.get("author"):
+                    caption += f"👤 By: {result['author']}\n"
+                caption += f"📸 {count} photos\n"
+                caption += "\n📥 TikTok Bot • Koyeb"
             
-            media_group = []
-            for i, img in enumerate(images):
-                if i == 0:
-                    caption = f"🖼️ {title}\n"
-                    if result.get("author"):
-                        caption += f"👤 By: {result['author']}\n"
-                    caption += f"📸 {len(images)} photos\n"
-                    caption += "\n📥 TikTok Bot • Koyeb"
-                    media_group.append(InputMediaPhoto(media=img, caption=caption[:1024]))
-                else:
-                    media_group.append(InputMediaPhoto(media=img))
+                # Upload the bytes ourselves; TikTok's signed URLs often fail for Telegram
+                photos = await fetch_images(images)
             
-            await update.message.reply_media_group(media=media_group)
-            await msg.delete()
+                # Caption goes on the first photo only
+                media_group = [InputMediaPhoto(media=photos[0], caption=caption[:1024])]
+                media_group += [InputMediaPhoto(media=photo) for photo in photos[1:]]
+            
+                await asyncio.gather(
+                    update.message.reply_media_group(media=media_group),
+                    msg.delete()
+                )
         
-        # Video
-        elif result["type"] == "video":
-            video_url = result["video_url"]
-            title = result["title"]
-            quality = result.get("quality", "Normal")
+            # Video
+            elif result["type"] == "video":
+                video_url = result["video_url"]
+                title = result["title"]
+                quality = result.get("quality", "Normal")
             
-            await msg.edit_text(f"🎬 Downloading {quality} quality video...")
+                await msg.edit_text(f"🎬 Downloading {quality} quality video...")
             
-            caption = f"🎬 {title}\n"
-            caption += f"📊 Quality: {quality}\n"
-            if result.get("author"):
-                caption += f"👤 By: {result['author']}\n"
-            caption += "\n📥 TikTok Bot • Koyeb"
+                caption = f"🎬 {title}\n"
+                caption += f"📊 Quality: {quality}\n"
+                if result.get("author"):
+                    caption += f"👤 By: {result['author']}\n"
+                caption += "\n📥 TikTok Bot • Koyeb"
             
-            await update.message.reply_video(
-                video=video_url,
-                caption=caption,
-                supports_streaming=True,
-                read_timeout=60,
-                write_timeout=60
-            )
-            await msg.delete()
+                # Upload the bytes ourselves; let Telegram fetch the URL only as fallback
+                try:
+                    video = await fetch_video(video_url)
+                except Exception as e:
+                    logger.warning("⚠️ Video download failed, sending URL instead: %s", e)
+                    video = video_url
+            
+                await asyncio.gather(
+                    update.message.reply_video(
+                        video=video,
+                        filename="tiktok.mp4",
+                        caption=caption,
+                        supports_streaming=True,
+                        read_timeout=60,
+                        write_timeout=60
+                    ),
+                    msg.delete()
+                )
     
-    except Exception as e:
-        logger.error(f"Error: {e}")
-        await msg.edit_text(f"❌ Error: {str(e)[:100]}")
+        except Exception as e:
+            logger.error("Error: %s", e)
+            try:
+                await msg.edit_text(f"❌ Error: {str(e)[:100]}")
+            except Exception:
+                # Status message may already be deleted
+                await update.message.reply_text(f"❌ Error: {str(e)[:100]}")
 
-def check_video_quality(video_url: str):
+async def check_video_quality(video_url: str):
     """Check video size and quality"""
     try:
         # Get video headers
-        response = requests.head(video_url, timeout=10, allow_redirects=True)
+        response = await MEDIA_HTTP.head(video_url, timeout=10, follow_redirects=True)
         
         size_bytes = int(response.headers.get('Content-Length', 0))
         size_mb = size_bytes / (1024 * 1024)
         
-        print(f"📊 Video Info:")
-        print(f"  • Size: {size_mb:.2f} MB ({size_bytes:,} bytes)")
-        print(f"  • Type: {response.headers.get('Content-Type', 'unknown')}")
-        print(f"  • URL: {video_url[:80]}...")
+        logger.debug(
+            "📊 Video Info: %.2f MB (%d bytes), %s, %.80s...",
+            size_mb, size_bytes, response.headers.get('Content-Type', 'unknown'), video_url
+        )
         
         # Determine quality based on size
         if size_mb > 5:
@@ -355,35 +787,62 @@ def check_video_quality(video_url: str):
         return quality, size_mb
         
     except Exception as e:
-        print(f"❌ Quality check error: {e}")
+        logger.warning("❌ Quality check error: %s", e)
         return "Unknown", 0
 
+# ============ LIFECYCLE ============
+
+async def post_init(application):
+    """Start health server and keep-alive once the event loop is running"""
+    application.bot_data["health_runner"] = await start_health_server()
+    application.bot_data["keep_alive_task"] = start_keep_alive()
+
+async def post_shutdown(application):
+    """Stop keep-alive and health server, close the shared HTTP clients"""
+    task = application.bot_data.get("keep_alive_task")
+    if task:
+        task.cancel()
+    runner = application.bot_data.get("health_runner")
+    if runner:
+        await runner.cleanup()
+    await HTTP.aclose()
+    await MEDIA_HTTP.aclose()
+
 # ============ MAIN ============
 
 def main():
     """Start the bot"""
-    print(f"🔑 Token loaded: {BOT_TOKEN[:10]}...")
-
-    print("⏳ Waiting for Flask to start...")
-    time.sleep(3)
-    
-    # Start keep-alive system
-    start_keep_alive()
+    logger.info("🔑 Token loaded: %.10s...", BOT_TOKEN)
     
     try:
         # Create bot
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(256)
+            .http_version("2")
+            .get_updates_http_version("2")
+            .rate_limiter(AIORateLimiter(
+                overall_max_rate=28,
+                overall_time_period=1,
+                group_max_rate=18,
+                group_time_period=60,
+                max_retries=3
+            ))
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
         
         # Add handlers
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("help", help_cmd))
         application.add_handler(CommandHandler("ping", ping))
+        application.add_handler(CommandHandler("stats", stats))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         
         # Start
-        print("=" * 60)
-        print("✅ Telegram bot starting...")
-        print("=" * 60)
+        logger.info("✅ Telegram bot starting...")
         
         application.run_polling(
             drop_pending_updates=True,
@@ -391,13 +850,9 @@ def main():
         )
         
     except Exception as e:
-        logger.error(f"Bot failed: {e}")
+        logger.error("Bot failed: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
-    # Wait a moment for Flask to start
-    import time
-    time.sleep(2)
-    
-    print("🚀 Starting bot components...")
+    logger.info("🚀 Starting bot components...")
     main()